@@ -1,8 +1,7 @@
 from __future__ import annotations
 
 import time
-from enum import Enum
-from typing import Any, Dict, List, Literal, Optional, Union
+from typing import Annotated, Any, Dict, List, Literal, Optional, Union
 
 from pydantic import BaseModel, ConfigDict, Field, model_validator
 
@@ -18,19 +17,13 @@ class OpenAIBaseModel(BaseModel):
     model_config = ConfigDict(extra='ignore')
 
 # ==========================================
-# Enums
+# Literals
 # ==========================================
 
-class ChatCompletionRole(str, Enum):
-    system = "system"
-    developer = "developer"
-    user = "user"
-    assistant = "assistant"
-    tool = "tool"
-    function = "function"
+# Enumだと検証・シリアライズ時にメンバー解決が挟まるため、Literalで表現する
+ChatCompletionRole = Literal["system", "developer", "user", "assistant", "tool", "function"]
 
-class FinishReason(str, Enum):
-    stop = "stop"
+FinishReason = Literal["stop"]
 
 # ==========================================
 # Message Content Parts
@@ -56,10 +49,14 @@ class ChatCompletionRequestMessageContentPartInputAudio(OpenAIBaseModel):
     type: Literal["input_audio"] = "input_audio"
     input_audio: InputAudio = Field(..., description="The audio content.")
 
-ChatCompletionRequestMessageContentPart = Union[
-    ChatCompletionRequestMessageContentPartText,
-    ChatCompletionRequestMessageContentPartImage,
-    ChatCompletionRequestMessageContentPartInputAudio
+# type/role をタグとする判別共用体にしておくと、検証時に候補を順に試さず一度で型が決まる
+ChatCompletionRequestMessageContentPart = Annotated[
+    Union[
+        ChatCompletionRequestMessageContentPartText,
+        ChatCompletionRequestMessageContentPartImage,
+        ChatCompletionRequestMessageContentPartInputAudio,
+    ],
+    Field(discriminator="type"),
 ]
 
 # ==========================================
@@ -100,13 +97,16 @@ class ChatCompletionRequestDeveloperMessage(OpenAIBaseModel):
     content: str = Field(..., description="The contents of the developer message.")
     name: Optional[str] = Field(None, description="An optional name for the participant.")
 
-ChatCompletionRequestMessage = Union[
-    ChatCompletionRequestSystemMessage,
-    ChatCompletionRequestDeveloperMessage,
-    ChatCompletionRequestUserMessage,
-    ChatCompletionRequestAssistantMessage,
-    ChatCompletionRequestToolMessage,
-    ChatCompletionRequestFunctionMessage,
+ChatCompletionRequestMessage = Annotated[
+    Union[
+        ChatCompletionRequestSystemMessage,
+        ChatCompletionRequestDeveloperMessage,
+        ChatCompletionRequestUserMessage,
+        ChatCompletionRequestAssistantMessage,
+        ChatCompletionRequestToolMessage,
+        ChatCompletionRequestFunctionMessage,
+    ],
+    Field(discriminator="role"),
 ]
 
 # ==========================================
@@ -117,6 +117,9 @@ class ResponseFormat(OpenAIBaseModel):
     type: Literal["text", "json_object", "json_schema"]
     json_schema: Optional[Dict[str, Any]] = None
 
+# Human Backend が対応していない response_format
+_UNSUPPORTED_RESPONSE_FORMATS = frozenset({"json_object", "json_schema"})
+
 class CreateChatCompletionRequest(OpenAIBaseModel):
     messages: List[ChatCompletionRequestMessage] = Field(..., description="A list of messages comprising the conversation so far.")
     model: str = Field(..., description="ID of the model to use.")
@@ -140,16 +143,16 @@ class CreateChatCompletionRequest(OpenAIBaseModel):
         
         # 1. Output Modalities Check
         if self.modalities:
-            for modality in self.modalities:
-                if modality != "text":
-                     raise ValueError(f"Human Chat Completions API does not support output modality '{modality}'. Only 'text' is supported.")
+            modality = next((m for m in self.modalities if m != "text"), None)
+            if modality is not None:
+                raise ValueError(f"Human Chat Completions API does not support output modality '{modality}'. Only 'text' is supported.")
 
         # 2. Store Check
         if self.store:
             raise ValueError("Human Chat Completions API does not support 'store=True'. Conversations are not persisted.")
 
         # 3. Response Format Check
-        if self.response_format and self.response_format.type in ["json_object", "json_schema"]:
+        if self.response_format and self.response_format.type in _UNSUPPORTED_RESPONSE_FORMATS:
             raise ValueError(f"Human Chat Completions API does not support response_format '{self.response_format.type}'. Only 'text' is supported.")
 
         # 4. Tool Choice Check
@@ -160,11 +163,14 @@ class CreateChatCompletionRequest(OpenAIBaseModel):
                  raise ValueError("Human Chat Completions API does not support specific tool selection.")
 
         # 5. Input Audio Check
-        for msg in self.messages:
-            if isinstance(msg, ChatCompletionRequestUserMessage) and isinstance(msg.content, list):
-                for part in msg.content:
-                    if getattr(part, "type", "") == "input_audio":
-                        raise ValueError("Human Chat Completions API does not support input audio messages.")
+        # 文字列contentのメッセージは role だけで除外し、パート配列を持つユーザーメッセージのみ走査する
+        if any(
+            part.type == "input_audio"
+            for msg in self.messages
+            if msg.role == "user" and isinstance(msg.content, list)
+            for part in msg.content
+        ):
+            raise ValueError("Human Chat Completions API does not support input audio messages.")
         
         # 6. Logprobs Check (重要: クライアントクラッシュ防止)
         if self.logprobs or self.top_logprobs:
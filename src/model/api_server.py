@@ -5,27 +5,40 @@
 import asyncio
 import threading
 import time
+import unicodedata
+from contextlib import asynccontextmanager
 from datetime import datetime
 from logging import getLogger
-from typing import AsyncGenerator, Awaitable, Callable, Optional
+from typing import AsyncGenerator, Awaitable, Callable, Iterator, Optional
 
+import orjson
 import uvicorn
-from fastapi import FastAPI, Header, HTTPException, Request
+from anyio import to_thread
+from fastapi import APIRouter, FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+try:
+    import uvloop
+except ImportError:  # Windows では uvloop が提供されていないため asyncio にフォールバック
+    uvloop = None
+
+try:
+    import httptools
+except ImportError:  # httptools のビルドが無い環境では純Pythonの h11 にフォールバック
+    httptools = None
 
 # 同じディレクトリにある api_model.py からインポート
 # フォルダ構成が異なる場合（例: modelフォルダ内にある場合）は適宜修正してください
 from model.api_model import (
     ChatCompletionChoice,
-    ChatCompletionChunk,
     ChatCompletionRequestMessage,
     ChatCompletionResponseMessage,
     ChatCompletionStreamChoice,
     ChatCompletionStreamResponseDelta,
     CreateChatCompletionRequest,
     CreateChatCompletionResponse,
-    FinishReason,
     ListModelsResponse,
     Model,
     OllamaListModelsResponse,
@@ -36,7 +49,115 @@ from model.api_model import (
 logger = getLogger(__name__)
 
 
+# 404レスポンスの本文は固定なので、起動時に一度だけシリアライズしておく
+_NOT_FOUND_BODY = orjson.dumps(
+    {
+        "error": "Not Found",
+        "message": "Human Chat Completions supports only POST /v1/chat/completions endpoint.",
+    }
+)
+
+# ストリーム終了シグナル
+_DONE = b"data: [DONE]\n\n"
+
+# チャンクのうち delta の中身以降の固定部分
+_TOKEN_CHUNK_TAIL = b'},"finish_reason":null}]}\n\n'
+
+# 完了時のChunk (finish_reason="stop", deltaは空) の choices 部分は全ストリームで共通なので、
+# 共有インスタンスから起動時に一度だけシリアライズしておく
+_EMPTY_DELTA = ChatCompletionStreamResponseDelta()
+_FINAL_CHOICE = ChatCompletionStreamChoice(index=0, delta=_EMPTY_DELTA, finish_reason="stop")
+_FINAL_CHUNK_TAIL = _FINAL_CHOICE.model_dump_json(exclude_none=True).encode() + b"]}\n\n"
+
+# SSE のコメント行。応答待ちの間、接続がプロキシ等にアイドル切断されないよう定期的に送る
+_PING = b": ping\n\n"
+
+# プロキシ (nginx 等) にバッファリング・キャッシュさせず、チャンクを即座にクライアントへ届ける
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# オペレーターの応答待ちの間に、クライアントの切断を確認する間隔（秒）
+_DISCONNECT_POLL_INTERVAL = 0.5
+
+_ZWJ = "\u200d"
+
+
+def _is_extend(ch: str) -> bool:
+    """
+    直前の文字と同じ書記素クラスタに含めるべき文字か（結合文字・異体字セレクタ・絵文字の肌色修飾子）
+    """
+    return unicodedata.category(ch) in ("Mn", "Me", "Mc") or "\U0001f3fb" <= ch <= "\U0001f3ff"
+
+
+def _is_regional_indicator(ch: str) -> bool:
+    return "\U0001f1e6" <= ch <= "\U0001f1ff"
+
+
+def _iter_grapheme_ends(text: str) -> Iterator[int]:
+    """
+    文字列を書記素クラスタ（見た目上の1文字）単位に区切った、各クラスタの終端インデックスを返します。
+    濁点などの結合文字・ZWJで連結された絵文字・国旗を途中で分割しないための簡易実装です。
+    """
+    start = 0
+    for i in range(1, len(text)):
+        ch = text[i]
+        prev = text[i - 1]
+        if (
+            _is_extend(ch)
+            or ch == _ZWJ
+            or prev == _ZWJ
+            or (
+                _is_regional_indicator(ch)
+                and _is_regional_indicator(prev)
+                and i - start == 1
+            )
+        ):
+            continue
+        yield i
+        start = i
+    if text:
+        yield len(text)
+
+
+def _iter_pieces(text: str, size: int) -> Iterator[str]:
+    """
+    文字列を size 個の書記素クラスタ毎にまとめたストリーミング単位に分割します。
+    1文字ずつのリストを作らず、元の文字列をインデックスで切り出します。
+    """
+    if text.isascii():
+        # ASCIIのみなら1文字=1クラスタなので、固定幅で切り出すだけでよい
+        for i in range(0, len(text), size):
+            yield text[i : i + size]
+        return
+
+    start = 0
+    count = 0
+    for end in _iter_grapheme_ends(text):
+        count += 1
+        if count >= size:
+            yield text[start:end]
+            start = end
+            count = 0
+    if start < len(text):
+        yield text[start:]
+
+
+def _json_response(model: BaseModel) -> Response:
+    """
+    Pydanticモデルをそのままシリアライズしたレスポンスを返します。
+    FastAPI の jsonable_encoder やレスポンスの再検証を経由しないため高速です。
+    （クライアント互換用に None のフィールドも出力する）
+    """
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
 class FastAPIServer:
+    """
+    Flet アプリ内のバックグラウンドスレッドで Uvicorn を動かすサーバー。
+
+    応答は on_message_received を通じて同一プロセス内のオペレーターUIから受け取るため、
+    ワーカーは常に1つとする（uvicorn --workers 等で別プロセスに分けるとUIへ到達できない）。
+    """
+
     def __init__(
         self,
         host: str,
@@ -45,12 +166,24 @@ class FastAPIServer:
         on_message_received: Callable[[Awaitable[ChatCompletionRequestMessage]], str],
         ssl_keyfile: Optional[str] = None,
         ssl_certfile: Optional[str] = None,
+        debug: bool = False,
+        thread_limit: int = 512,
+        stream_chunk_size: int = 4,
+        stream_delay: float = 0.05,
+        stream_ping_interval: float = 15.0,
     ):
+        # 送出を始めてから（レスポンスヘッダーの送信後に）失敗しないよう、ここで弾いておく
+        if stream_chunk_size < 1:
+            raise ValueError(f"stream_chunk_size must be at least 1, got {stream_chunk_size}.")
+        # 0 以下だと応答待ちの間 ping を休みなく送り続けてしまう
+        if stream_ping_interval <= 0:
+            raise ValueError(f"stream_ping_interval must be positive, got {stream_ping_interval}.")
         self.app = FastAPI(
             title="Human Chat Completions",
             summary="OpenAI Chat Completions API compatible API.",
             description="Human Chat Completions is a simple HTTP server that implements the OpenAI Chat Completions API.",
             version="0.1.0",
+            lifespan=self.lifespan,
         )
         self.app.add_middleware(
             CORSMiddleware,
@@ -59,27 +192,32 @@ class FastAPIServer:
             allow_methods=["*"],
             allow_headers=["*"],
         )
-        self.app.add_api_route(
+        # ルートは APIRouter にまとめて一度に登録する
+        # ヘルスチェック用の "/" と別名の "/chat/completions" は OpenAPI スキーマに含めない
+        router = APIRouter()
+        router.add_api_route(
             "/",
             self.root,
             methods=["GET", "POST", "PUT", "DELETE", "PATCH", "HEAD"],
+            include_in_schema=False,
         )
-        self.app.add_api_route(
+        router.add_api_route(
             "/v1/chat/completions",
             self.chat_completions,
             methods=["POST"],
         )
-        self.app.add_api_route(
+        router.add_api_route(
             "/chat/completions",
             self.chat_completions,
             methods=["POST"],
+            include_in_schema=False,  # /v1/chat/completions の別名
         )
-        self.app.add_api_route(
+        router.add_api_route(
             "/v1/models",
             self.list_models,
             methods=["GET"],
         )
-        self.app.add_api_route(
+        router.add_api_route(
             "/v1/models/{model_id}",
             self.retrieve_model,
             methods=["GET"],
@@ -88,42 +226,90 @@ class FastAPIServer:
             operation_id="retrieveModel",
             response_model=Model,
         )
-        self.app.add_api_route(
+        router.add_api_route(
             "/api/tags",
             self.list_models_ollama,
             methods=["GET"],
             tags=["Ollama Compatibility"],
             summary="List models (Ollama)",
             operation_id="listModelsOllama",
-            response_model=OllamaListModelsResponse
+            response_model=OllamaListModelsResponse,
         )
+        self.app.include_router(router)
         self.app.add_exception_handler(404, self.not_found_handler)
         self.config = uvicorn.Config(
             self.app,
             host=host,
             port=port,
             log_level=log_level,
+            # アクセスログはリクエスト毎に出力されるため、デバッグ時のみ有効にする
+            access_log=debug,
             ssl_keyfile=ssl_keyfile,
             ssl_certfile=ssl_certfile,
-            loop="asyncio",
+            # uvicorn は Server.run() の中でこの指定からループを作る（プロセス全体のポリシーは変更しない）
+            loop="uvloop" if uvloop else "asyncio",
+            http="httptools" if httptools else "h11",
         )
         self.server = uvicorn.Server(self.config)
         self._thread = None
         self.on_message_received = on_message_received
         self.port = port
         self.launch_time = time.time()
+        self.thread_limit = thread_limit
+
+        # モデル一覧は起動中に変化しないため、レスポンスを一度だけシリアライズしておく
+        # 許可するモデルの定義 (model_id -> Model)
+        self._allowed_models: dict[str, Model] = {
+            "human": Model(id="human", created=int(self.launch_time), owned_by="human-backend"),
+        }
+        self._models_payload = (
+            ListModelsResponse(data=list(self._allowed_models.values())).model_dump_json().encode()
+        )
+        # model_id -> シリアライズ済みのモデル情報
+        self._model_payloads = {
+            model_id: model.model_dump_json().encode()
+            for model_id, model in self._allowed_models.items()
+        }
+        self._ollama_models_payload = OllamaListModelsResponse(
+            models=[
+                OllamaModel(
+                    name="human:latest",
+                    model="human:latest",
+                    modified_at=datetime.fromtimestamp(self.launch_time).isoformat(),
+                    details=OllamaModelDetails()
+                ),
+            ]
+        ).model_dump_json().encode()
+        # ストリーミング時に1チャンクへまとめる文字数と、チャンク毎の擬似的なタイピング遅延（秒）
+        # stream_delay=0 で遅延なしの回線速度で送出する
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_delay = stream_delay
+        # ストリーミング時、オペレーターの応答待ちの間に ping を送る間隔（秒）
+        self.stream_ping_interval = stream_ping_interval
+
+    @asynccontextmanager
+    async def lifespan(self, app: FastAPI):
+        # 同期処理をスレッドへ逃がす際の同時実行数の上限（anyio の既定値は40）
+        # リミッターはイベントループ毎に作られるため、サーバーのループ上で設定する
+        to_thread.current_default_thread_limiter().total_tokens = self.thread_limit
+        yield
+
+    async def serve(self):
+        """
+        呼び出し元のイベントループ上でサーバーを実行します（停止するまで戻りません）。
+        スレッドを介さないため、ライブラリとして組み込む場合はこちらを推奨します。
+        """
+        await self.server.serve()
 
     def start(self):
+        """
+        バックグラウンドスレッドでサーバーを起動します（Flet アプリからの利用向け）。
+        """
         if self._thread and self._thread.is_alive():
             return
 
-        def target():
-            # スレッド内で新しいイベントループを作成・設定
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            self.server.run()
-
-        self._thread = threading.Thread(target=target, daemon=True)
+        # Server.run() は Config の loop 指定から作ったループでサーバーを実行し、終了時に閉じる
+        self._thread = threading.Thread(target=self.server.run, daemon=True)
         self._thread.start()
 
     def stop(self, timeout: float = 5.0):
@@ -132,7 +318,10 @@ class FastAPIServer:
         if self._thread and self._thread.is_alive():
             self._thread.join(timeout)
             if self._thread.is_alive():
-                logger.warning("Uvicorn thread did not exit gracefully.")
+                # 接続中のリクエスト（オペレーターの応答待ちなど）の完了を待たずに終了させる
+                logger.warning("Uvicorn thread did not exit gracefully. Forcing exit.")
+                self.server.force_exit = True
+                self._thread.join(timeout)
 
     # ==========================================
     # Streaming Generator
@@ -140,103 +329,161 @@ class FastAPIServer:
 
     async def stream_generator(
         self, content: str, model_id: str
-    ) -> AsyncGenerator[str, None]:
+    ) -> AsyncGenerator[bytes, None]:
         """
         Server-Sent Events (SSE) 形式でレスポンスをストリーミングします。
         """
-        chunk_id = f"chatcmpl-{int(time.time())}"
         created_time = int(time.time())
+        chunk_id = f"chatcmpl-{created_time}"
 
-        # 文字単位でストリーミングするシミュレーション
-        tokens = list(content)
-
-        for i, token in enumerate(tokens):
-            # 擬似的なタイピング遅延
-            await asyncio.sleep(0.05)
+        # id/created/model はストリーム中で不変なので、トークン用チャンクは事前にシリアライズした
+        # テンプレートにJSONエスケープ済みのトークンを差し込むだけにする
+        # (Pydanticモデルの構築・シリアライズをトークン毎に行わない)
+        chunk_head = (
+            b'data: {"id":' + orjson.dumps(chunk_id)
+            + b',"object":"chat.completion.chunk","created":' + str(created_time).encode()
+            + b',"model":' + orjson.dumps(model_id)
+            + b',"system_fingerprint":"fp_human_backend","choices":['
+        )
+        first_head = chunk_head + b'{"index":0,"delta":{"role":"assistant","content":'
+        token_head = chunk_head + b'{"index":0,"delta":{"content":'
 
-            chunk = ChatCompletionChunk(
-                id=chunk_id,
-                created=created_time,
-                model=model_id,
-                choices=[
-                    ChatCompletionStreamChoice(
-                        index=0,
-                        delta=ChatCompletionStreamResponseDelta(
-                            # 最初のチャンクだけroleを入れる（仕様上は毎回でも可だが、一般的実装に合わせる）
-                            role="assistant" if i == 0 else None,
-                            content=token,
-                        ),
-                        finish_reason=None,
-                    )
-                ],
-            )
+        # 数文字（書記素クラスタ）ずつストリーミングするシミュレーション
+        # 送出するSSEフレームは先に全て組み立てておき、ストリーミング中は待機と送出だけを行う
+        # SSE形式: data: <json_string>\n\n
+        frames = [
+            # 最初のチャンクだけroleを入れる（仕様上は毎回でも可だが、一般的実装に合わせる）
+            (first_head if i == 0 else token_head) + orjson.dumps(piece) + _TOKEN_CHUNK_TAIL
+            for i, piece in enumerate(_iter_pieces(content, self.stream_chunk_size))
+        ]
 
-            # SSE形式: data: <json_string>\n\n
-            yield f"data: {chunk.model_dump_json(exclude_none=True)}\n\n"
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for i, frame in enumerate(frames):
+            # 擬似的なタイピング遅延
+            # 開始時刻からの締切で刻むことで、イベントループが混雑していても遅延が累積せず、
+            # 遅れている間は待たずに続けて送出する
+            if self.stream_delay > 0:
+                delay = start + (i + 1) * self.stream_delay - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # bytes で渡すと StreamingResponse 側での encode が不要になる
+            yield frame
 
         # 完了時のChunk (finish_reason="stop", contentは空)
-        final_chunk = ChatCompletionChunk(
-            id=chunk_id,
-            created=created_time,
-            model=model_id,
-            choices=[
-                ChatCompletionStreamChoice(
-                    index=0,
-                    delta=ChatCompletionStreamResponseDelta(),
-                    finish_reason=FinishReason.stop,
-                )
-            ],
-            # usageを送る場合はここに `usage=...` を追加
-        )
-        yield f"data: {final_chunk.model_dump_json(exclude_none=True)}\n\n"
+        # usageを送る場合はここに `usage` を追加
+        yield chunk_head + _FINAL_CHUNK_TAIL
 
         # ストリーム終了シグナル
-        yield "data: [DONE]\n\n"
+        yield _DONE
+
+    async def _stream_response(
+        self, messages: list[ChatCompletionRequestMessage], model_id: str
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        オペレーターの応答を待つ間は ping を送り、応答が確定したら stream_generator の内容を流します。
+        """
+        task = asyncio.ensure_future(self.on_message_received(messages))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=self.stream_ping_interval)
+                if done:
+                    break
+                yield _PING
+        finally:
+            # クライアントの切断でジェネレーターが閉じられた場合は、応答待ちも止める
+            task.cancel()
+
+        async for frame in self.stream_generator(task.result(), model_id):
+            yield frame
 
     # ==========================================
     # Endpoints
     # ==========================================
 
     async def root(self, request: Request):
-        return {
-            "message": f"Human Chat Completions listening on port {self.port}.\nUsage: POST /chat/completions or /v1/chat/completions.",
-            "request": {
-                "method": request.method,
-                "url": request.url,
-                "query_params": request.query_params,
-                "headers": request.headers,
-                "body": await request.body(),
-            }
-        }
+        # ヘルスチェック等の GET/HEAD ではボディを読み込まない（受信チャネルの読み切りを避ける）
+        body = (
+            (await request.body()).decode(errors="replace")
+            if request.method in ("POST", "PUT", "PATCH")
+            else None
+        )
+        # jsonable_encoder を通さず、素の型に変換した dict を直接シリアライズして返す
+        return Response(
+            content=orjson.dumps(
+                {
+                    "message": f"Human Chat Completions listening on port {self.port}.\nUsage: POST /chat/completions or /v1/chat/completions.",
+                    "request": {
+                        "method": request.method,
+                        "url": str(request.url),
+                        "query_params": dict(request.query_params),
+                        "headers": dict(request.headers),
+                        "body": body,
+                    },
+                }
+            ),
+            media_type="application/json",
+        )
+
+    async def _wait_for_response(
+        self, raw_request: Request, messages: list[ChatCompletionRequestMessage]
+    ) -> Optional[str]:
+        """
+        on_message_received の完了を待ちます。
+        待機中にクライアントが切断した場合は処理をキャンセルし、None を返します。
+        """
+        task = asyncio.ensure_future(self.on_message_received(messages))
+        try:
+            while True:
+                done, _ = await asyncio.wait({task}, timeout=_DISCONNECT_POLL_INTERVAL)
+                if done:
+                    return task.result()
+                if await raw_request.is_disconnected():
+                    logger.info("Client disconnected while waiting for the response.")
+                    task.cancel()
+                    return None
+        except asyncio.CancelledError:
+            # サーバー停止などでこのリクエスト自体がキャンセルされた場合も待機を止める
+            task.cancel()
+            raise
 
     async def chat_completions(
         self,
         request: CreateChatCompletionRequest,
+        raw_request: Request,
         authorization: Optional[str] = Header(None),
     ):
         """
         OpenAI互換のChat Completionsエンドポイント
         """
-        # 1. 応答内容の取得（ビジネスロジック呼び出し）
-        # ストリーミングの場合でも、現状は「全応答が決まってから流す」方式としています
         logger.debug(request.messages)
-        response_content = await self.on_message_received(request.messages)
 
         # モデルIDの取得
         model_id = request.model
 
-        # 2. ストリーミングリクエストの場合
+        # 1. ストリーミングリクエストの場合
+        # オペレーターの応答を待つ間も接続を維持できるよう、ヘッダーを先に返して ping を送りながら待つ
+        # 送出中の切断は StreamingResponse が検知してジェネレーターごとキャンセルするため、
+        # ここで is_disconnected() を重ねて呼ぶ必要はない（受信チャネルの取り合いになる）
         if request.stream:
             return StreamingResponse(
-                self.stream_generator(response_content, model_id),
+                self._stream_response(request.messages, model_id),
                 media_type="text/event-stream",
+                headers=_SSE_HEADERS,
             )
 
+        # 2. 応答内容の取得（ビジネスロジック呼び出し）
+        response_content = await self._wait_for_response(raw_request, request.messages)
+        if response_content is None:
+            # クライアントは既に切断しているため、本文は返さない（nginx の 499 に倣う）
+            return Response(status_code=499)
+
         # 3. 通常リクエストの場合
-        else:
-            return CreateChatCompletionResponse(
-                id=f"chatcmpl-{int(time.time())}",
-                created=int(time.time()),
+        created_time = int(time.time())
+        return _json_response(
+            CreateChatCompletionResponse(
+                id=f"chatcmpl-{created_time}",
+                created=created_time,
                 model=model_id,
                 choices=[
                     ChatCompletionChoice(
@@ -244,32 +491,25 @@ class FastAPIServer:
                         message=ChatCompletionResponseMessage(
                             role="assistant", content=response_content
                         ),
-                        finish_reason=FinishReason.stop,
+                        finish_reason="stop",
                     )
                 ],
             )
+        )
     
     async def list_models(self):
         """
         利用可能なモデルのリストを返します。
         """
-        return ListModelsResponse(
-            data=[
-                Model(id="human", created=int(self.launch_time), owned_by="human-backend"),
-            ]
-        )
+        return Response(content=self._models_payload, media_type="application/json")
     
     async def retrieve_model(self, model_id: str):
         """
         特定のモデル情報を取得します。
         OpenAI API互換のため、GET /v1/models/human 等に対応します。
         """
-        # 許可するモデルの定義
-        allowed_models = {
-            Model(id="human", created=int(self.launch_time), owned_by="human-backend"),
-        }
-
-        if model_id not in allowed_models:
+        payload = self._model_payloads.get(model_id)
+        if payload is None:
             raise HTTPException(
                 status_code=404,
                 detail={
@@ -282,28 +522,24 @@ class FastAPIServer:
                 }
             )
         
-        return allowed_models[model_id]
+        return Response(content=payload, media_type="application/json")
     
     async def list_models_ollama(self):
         """
         Ollama互換のモデル一覧エンドポイントです。
         """
-        return OllamaListModelsResponse(
-            models=[
-                OllamaModel(
-                    name="human:latest",
-                    model="human:latest",
-                    modified_at=datetime.fromtimestamp(self.launch_time).isoformat(),
-                    details=OllamaModelDetails()
-                ),
-            ]
-        )
+        return Response(content=self._ollama_models_payload, media_type="application/json")
 
     async def not_found_handler(self, request: Request, exc: HTTPException):
-        return JSONResponse(
+        # retrieve_model などが付けたエラー詳細はそのまま返す（ルート不一致時の detail は文字列）
+        if isinstance(exc.detail, dict):
+            return Response(
+                content=orjson.dumps(exc.detail),
+                status_code=404,
+                media_type="application/json",
+            )
+        return Response(
+            content=_NOT_FOUND_BODY,
             status_code=404,
-            content={
-                "error": "Not Found",
-                "message": "Human Chat Completions supports only POST /v1/chat/completions endpoint.",
-            },
+            media_type="application/json",
         )
@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 from logging import getLogger
 
 import httpx
@@ -7,26 +8,37 @@ from __version__ import VERSION
 
 logger = getLogger(__name__)
 
-client = httpx.AsyncClient()
+# 外部へのHTTP通信はこのクライアントを使い回す（HTTP/2で1本の接続を多重化し、TLSハンドシェイクを省く）
+client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=10, max_connections=20),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+    follow_redirects=True,
+)
 current = VERSION
 
+_RELEASES_URL = "https://api.github.com/repos/miyamoto-hai-lab/human-chat-completions/releases"
+_GITHUB_HEADERS = {
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+    "User-Agent": "miyamoto-hai-lab/human-chat-completions update-checker",
+}
+
+# 数字または単語で分割
+_VERSION_TOKEN_RE = re.compile(r"\d+|[a-zA-Z]+")
+# 頭につくversionなどの接頭辞
+_VERSION_PREFIXES = frozenset({"v", "ver", "version", "vol"})
+# プレリリースを表す文字列
+_PRERELEASE_TOKENS = frozenset({"a", "alpha", "b", "beta", "canary", "rc", "pre", "preview"})
+
 
 async def check_update_available():
     try:
-        res = await client.get(
-            "https://api.github.com/repos/miyamoto-hai-lab/human-chat-completions/releases",
-            headers={
-                "Accept": "application/vnd.github+json",
-                "X-GitHub-Api-Version": "2022-11-28",
-                "User-Agent": "miyamoto-hai-lab/human-chat-completions update-checker",
-            },
-            timeout=30,
-            follow_redirects=True,
-        )
-        if res.status_code == 200:
-            latest = sorted(res.json(), key=lambda d: d["published_at"], reverse=True)[
-                0
-            ]["tag_name"].lstrip("v")
+        latest = await _fetch_latest_tag(f"{_RELEASES_URL}/latest")
+        if latest is None:
+            # 正式リリースが無い（プレリリースのみ）場合は一覧から最新のものを探す
+            latest = await _fetch_latest_tag(_RELEASES_URL)
+        if latest is not None:
             return version_parse(latest) > version_parse(current), current, latest
         else:
             return False, current, "unknown"
@@ -35,26 +47,39 @@ async def check_update_available():
         return False, current, "unknown"
 
 
+async def _fetch_latest_tag(url):
+    """
+    GitHub API から最新リリースのタグ名を取得する．取得できなければ None を返す
+    """
+    res = await client.get(url, headers=_GITHUB_HEADERS)
+    if res.status_code != 200:
+        return None
+
+    data = res.json()
+    if isinstance(data, list):
+        if not data:
+            return None
+        data = max(data, key=lambda d: d["published_at"] or "")
+    return data["tag_name"].lstrip("v")
+
+
+@lru_cache(maxsize=256)
 def version_parse(text):
     """バージョンを不等号で比較可能なタプルにして返す"""
 
     # 数字または単語で分割
-    version_split = re.findall(r"\d+|[a-zA-Z]+", text)
+    version_split = _VERSION_TOKEN_RE.findall(text)
 
     # 頭にversionなどがついていたら除去
-    prefix = ["v", "ver", "version", "vol"]
-    if version_split[0].lower() in prefix:
+    if version_split[0].lower() in _VERSION_PREFIXES:
         version_split = version_split[1:]
 
-    # プレリリースを表す文字列
-    prerelease_str = ["a", "alpha", "b", "beta", "canary", "rc", "pre", "preview"]
-
     output = []
 
     for item in version_split:
         if item.isdecimal():
             output.append((int(item), ""))
-        elif item.lower() in prerelease_str:
+        elif item.lower() in _PRERELEASE_TOKENS:
             output.append((-1, item))
         else:
             output.append((0, item))
@@ -2,13 +2,19 @@
 レスポンス構築補助用のLLM
 """
 
-from typing import Any, Dict, Optional
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
 
 from langchain.chat_models import init_chat_model
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages import (
+    AIMessage,
+    HumanMessage,
+    SystemMessage,
+    convert_to_messages,
+)
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables.base import RunnableLambda
-from pydantic import BaseModel, Field
+from langchain_core.runnables.base import Runnable, RunnableLambda
+from pydantic import BaseModel, ConfigDict, Field
 
 # LLMへの固定システムプロンプト（タスク定義）
 SYSTEM_TEMPLATE = """あなたはチャットボットの返信作成支援AIです。
@@ -35,11 +41,38 @@ HUMAN_TEMPLATE = """以下の情報を元に、返信を生成してください
 
 返信候補をJSON形式で出力してください:"""
 
+# 会話履歴に含めるメッセージの型と、テキスト化する際の話者名
+HISTORY_SPEAKERS = {HumanMessage: "User", AIMessage: "Assistant"}
+
+
+@lru_cache(maxsize=None)
+def _history_speaker(cls: type) -> Optional[str]:
+    """
+    メッセージの型の話者名を返します。会話履歴に含めない型であれば None を返します。
+    AIMessageChunk などのサブクラスは、基底クラスの話者名を使う
+    """
+    for base in cls.__mro__:
+        speaker = HISTORY_SPEAKERS.get(base)
+        if speaker is not None:
+            return speaker
+    return None
+
 
 class Copilot:
     def __init__(
         self, model_provider: str, model_name: str, api_key: Optional[str] = None
     ):
+        self.chain = self._build_chain(model_provider, model_name, api_key)
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def _build_chain(
+        model_provider: str, model_name: str, api_key: Optional[str]
+    ) -> Runnable:
+        """
+        プロンプトと構造化出力 (DraftResponse) を組み込んだチェーンを構築します。
+        構造化出力のスキーマ生成は重いため、同じモデル設定のチェーンは使い回す
+        """
         chat_model = init_chat_model(
             model_name,
             model_provider=model_provider,
@@ -48,8 +81,8 @@ class Copilot:
         prompt = ChatPromptTemplate.from_messages(
             [("system", SYSTEM_TEMPLATE), ("human", HUMAN_TEMPLATE)]
         )
-        self.chain = (
-            RunnableLambda(self._process_inputs)
+        return (
+            RunnableLambda(Copilot._process_inputs)
             | prompt
             | chat_model.with_structured_output(DraftResponse)
         )
@@ -72,42 +105,57 @@ class Copilot:
         ):
             yield chunk
 
-    def _process_inputs(self, inputs: Dict[str, Any]) -> Dict[str, str]:
+    @staticmethod
+    def _process_inputs(inputs: Dict[str, Any]) -> Dict[str, str]:
         """
         入力辞書から必要な情報を抽出し、プロンプトに埋め込む文字列を生成します。
+        同じ会話履歴・指示に対する結果はキャッシュされます（再試行やテスト時の同一入力など）。
         """
-        messages = inputs.get("messages", [])
+        # {"role": ..., "content": ...} の dict で渡された履歴もメッセージオブジェクトに揃える
+        messages = convert_to_messages(inputs.get("messages", []))
         copilot_instruction = inputs.get("instruction", "")  # ユーザ入力の指示（任意）
 
-        # A. 会話内システムプロンプトの抽出と履歴の分離
-        inner_sys_content = "特になし（一般的なAIとして振る舞ってください）"
-        history_msgs = []
-
-        for m in messages:
-            if isinstance(m, SystemMessage):
-                # 会話内システムプロンプトとして扱う
-                inner_sys_content = m.content
-            else:
-                history_msgs.append(m)
+        key = tuple((type(m), m.content) for m in messages)
+        if all(isinstance(content, str) for _, content in key):
+            return dict(_format_prompt_inputs(key, copilot_instruction))
+        # content がリスト（マルチモーダル）の場合はハッシュできないため、キャッシュせずに処理する
+        return _format_prompt_inputs.__wrapped__(key, copilot_instruction)
 
-        # B. Copilot指示のデフォルト値処理
-        formatted_instruction = (
-            copilot_instruction if copilot_instruction else "特になし"
-        )
 
-        # C. 会話履歴のテキスト化
-        formatted_history = ""
-        for m in history_msgs:
-            if isinstance(m, HumanMessage):
-                formatted_history += f"User: {m.content}\n"
-            elif isinstance(m, AIMessage):
-                formatted_history += f"Assistant: {m.content}\n"
+@lru_cache(maxsize=128)
+def _format_prompt_inputs(
+    messages: Tuple[Tuple[type, Any], ...], copilot_instruction: str
+) -> Dict[str, str]:
+    """
+    (メッセージの型, content) の組の列から、プロンプトに埋め込む文字列を生成します。
+    """
+    # A. 会話内システムプロンプトの抽出と、会話履歴のテキスト化（1回の走査で行う）
+    # 文字列の += 連結は履歴が長いと二乗オーダーになり得るため、リストに溜めて最後に結合する
+    inner_sys_content = "特になし（一般的なAIとして振る舞ってください）"
+    history_lines = []
+    append = history_lines.append
+    get_speaker = _history_speaker
+    system_message = SystemMessage
+
+    for cls, content in messages:
+        speaker = get_speaker(cls)
+        if speaker is not None:
+            append(f"{speaker}: {content}\n")
+        elif issubclass(cls, system_message):
+            # 会話内システムプロンプトとして扱う
+            inner_sys_content = content
+    formatted_history = "".join(history_lines)
+
+    # B. Copilot指示のデフォルト値処理
+    formatted_instruction = (
+        copilot_instruction if copilot_instruction else "特になし"
+    )
 
-        return {
-            "copilot_instruction": formatted_instruction,
-            "inner_system_prompt": inner_sys_content,
-            "formatted_history": formatted_history,
-        }
+    return {
+        "copilot_instruction": formatted_instruction,
+        "inner_system_prompt": inner_sys_content,
+        "formatted_history": formatted_history,
+    }
 
 
 class DraftResponse(BaseModel):
@@ -116,6 +164,9 @@ class DraftResponse(BaseModel):
     返信として適切なものから順に draft1, draft2, draft3 に格納される。
     """
 
+    # 生成結果は読み取り専用。未知のフィールドは受け付けない（スキーマ上も additionalProperties: false になる）
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     draft1: str = Field(
         ...,
         description="最も適切/推奨される返信案。全ての指示とコンテキストを最も自然に満たすもの。",
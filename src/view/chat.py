@@ -3,8 +3,12 @@
 """
 
 import asyncio
+import os
 import socket
-from contextlib import closing
+import threading
+import time
+from collections import deque
+from typing import Callable, Optional
 
 import flet as ft
 
@@ -17,6 +21,99 @@ from model.api_model import (
 )
 from model.api_server import FastAPIServer
 
+# 解決済みのローカルIPアドレスと取得時刻 (time.monotonic(), ip)
+# 有効期限内であれば、2つ目以降の ChatView ではソケットを開いて再取得しない
+_IP_CACHE: Optional[tuple[float, str]] = None
+_IP_CACHE_TTL = 60.0
+
+# 表示するIPアドレスを固定したい場合（複数のNICがある環境など）に指定する環境変数
+_IP_OVERRIDE_ENV = "HCC_BIND_IP"
+
+
+def _cached_local_ip() -> Optional[str]:
+    """
+    環境変数での指定、または有効期限内のキャッシュがあればそのIPアドレスを返す
+    """
+    override = os.environ.get(_IP_OVERRIDE_ENV)
+    if override:
+        return override
+    if _IP_CACHE is not None and time.monotonic() - _IP_CACHE[0] < _IP_CACHE_TTL:
+        return _IP_CACHE[1]
+    return None
+
+
+def _always(message: ChatCompletionRequestMessage) -> bool:
+    return True
+
+
+def _has_text_content(message: ChatCompletionRequestUserMessage) -> bool:
+    return isinstance(message.content, str)  # TODO: PartMessageを処理する
+
+
+# 表示するメッセージの型 -> 表示するかの判定関数（isinstance の連鎖を型による辞書引き1回にする）
+# ここに無い型（tool / function メッセージ）は表示しない
+_MESSAGE_FILTERS: dict[type, Callable[[ChatCompletionRequestMessage], bool]] = {
+    ChatCompletionRequestSystemMessage: _always,
+    ChatCompletionRequestDeveloperMessage: _always,
+    ChatCompletionRequestUserMessage: _has_text_content,
+    ChatCompletionRequestAssistantMessage: _always,
+}
+
+
+def _is_displayed(message: ChatCompletionRequestMessage) -> bool:
+    is_displayed = _MESSAGE_FILTERS.get(type(message))
+    return is_displayed is not None and is_displayed(message)
+
+
+# 「システムメッセージを非表示」で除外する型
+_SYSTEM_MESSAGE_TYPES = frozenset(
+    {ChatCompletionRequestSystemMessage, ChatCompletionRequestDeveloperMessage}
+)
+
+
+# 吹き出しのスタイル（ユーザ側は左寄せの白、応答側は右寄せの青）
+_ALIGN_USER = ft.MainAxisAlignment.START
+_ALIGN_AI = ft.MainAxisAlignment.END
+_BG_USER = ft.Colors.WHITE
+_BG_AI = ft.Colors.BLUE_600
+_TXT_USER = ft.Colors.BLACK
+_TXT_AI = ft.Colors.WHITE
+
+# レイアウトで使う不変のスタイルオブジェクト（ChatView を作る毎に生成しない）
+_PORT_FIELD_PADDING = ft.padding.symmetric(horizontal=10, vertical=0)
+_LISTEN_BUTTON_STYLE = ft.ButtonStyle(shape=ft.RoundedRectangleBorder(radius=5))
+_IP_TEXT_STYLE = ft.TextStyle(size=12)
+_TOP_BAR_PADDING = ft.padding.symmetric(horizontal=10, vertical=5)
+_INPUT_AREA_PADDING = ft.padding.all(10)
+_TOP_BORDER = ft.border.only(top=ft.BorderSide(1, "outlineVariant"))
+_BOTTOM_BORDER = ft.border.only(bottom=ft.BorderSide(1, "outlineVariant"))
+
+# 一覧に表示する吹き出しの上限数（超えた分は古いものから外す）
+MAX_BUBBLES = 500
+
+# 再利用のために保持しておく吹き出しの上限数
+_BUBBLE_POOL_SIZE = 256
+
+
+def _set_reply(future: asyncio.Future, message: str):
+    """
+    応答待ちのリクエストへ応答を渡す（サーバーのイベントループ上で呼ぶ）
+    受け渡しまでの間にクライアント切断等でキャンセルされていた場合は何もしない
+    """
+    if not future.done():
+        future.set_result(message)
+
+
+def _common_prefix_length(a: list, b: list) -> int:
+    """
+    2つのリストの先頭から一致している要素数を返す
+    """
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
 
 class ChatView(ft.Container):
     def __init__(self, page: ft.Page):
@@ -27,15 +124,13 @@ class ChatView(ft.Container):
             width=100,
             text_size=12,
             height=40,
-            content_padding=ft.padding.symmetric(horizontal=10, vertical=0),
+            content_padding=_PORT_FIELD_PADDING,
         )
         self.listen_button = ft.ElevatedButton(
             "STOPPED",
             bgcolor=ft.Colors.RED_400,
             color=ft.Colors.WHITE,
-            style=ft.ButtonStyle(
-                shape=ft.RoundedRectangleBorder(radius=5),
-            ),
+            style=_LISTEN_BUTTON_STYLE,
             on_click=self.toggle_server,
         )
 
@@ -45,8 +140,27 @@ class ChatView(ft.Container):
             padding=20,
             auto_scroll=True,
         )
+        # 表示中の吹き出しの (本文, role) の並び。messages_list.controls と常に同じ長さ
+        self._last_messages: list[tuple[str, str]] = []
+        # _last_messages[0] が会話履歴の何番目のメッセージか（古い吹き出しを外した件数）
+        self._first_index = 0
+        # 一覧から外した吹き出し (Row) の再利用待ち
+        self._bubble_pool: list[ft.Row] = []
+        # 前回の画面への反映以降に一覧から外した吹き出し
+        # 同じ update 内で外して付け直すと差分計算が崩れるため、反映が済んでからプールに入れる
+        self._evicted_rows: list[ft.Row] = []
+        # 吹き出しの一覧・入力欄などの表示を変更する際のロック（Flet 側のスレッドだけが取る）
+        # Flet クライアントへの送信 (page.update) の間も保持する
+        self._view_lock = threading.Lock()
+        # 応答待ちの並び (_response_queues) を読み書きする際のロック
+        # サーバーのイベントループからも取るため、Flet への送信中など時間のかかる処理の間は保持しない
+        self._queue_lock = threading.Lock()
+        # 画面に会話履歴を表示している応答待ちのリクエスト（_view_lock を取って読み書きする）
+        self._shown_entry = None
 
         self.api_server = None
+        # サーバーの起動・停止処理中かどうか（連打による二重起動・停止を防ぐ）
+        self._toggle_lock = threading.Lock()
 
         self.input_field = ft.TextField(
             hint_text="メッセージが来たらここへ入力...",
@@ -62,14 +176,28 @@ class ChatView(ft.Container):
         def send_message(e):
             if self.input_field.value.strip() == "":
                 return
-            self._add_message(self.input_field.value, is_user=False, is_response=True)
-            self.input_field.value = ""
-            self.input_field.hint_text = "メッセージが来たらここへ入力..."
-            self.input_field.disabled = True
-            self.send_button.disabled = True
-            self.send_button.bgcolor=ft.Colors.GREY_400
-            self.input_field.update()
-            self.send_button.update()
+            with self._view_lock:
+                # 応答は画面に会話履歴を表示しているリクエストへ渡す
+                entry = self._shown_entry
+                if entry is None:
+                    return
+                with self._queue_lock:
+                    try:
+                        self._response_queues.remove(entry)
+                        is_pending = True
+                    except ValueError:
+                        # クライアント切断等で既に待ち行列から外れている
+                        is_pending = False
+                loop, future, _ = entry
+                # 表示中のリクエストが既にキャンセルされていた場合は、入力内容を残したまま次のリクエストを表示する
+                if is_pending and not future.done():
+                    message = self.input_field.value
+                    self._add_message(message, "assistant")
+                    # サーバーは別スレッドのイベントループで動いているため、そのループ上で渡す
+                    loop.call_soon_threadsafe(_set_reply, future, message)
+                    self.input_field.value = ""
+                # 続けて応答待ちのリクエストがあればその会話履歴を表示し、無ければ入力を無効にする
+                self._render_pending()
 
         self.send_button = ft.IconButton(
             icon=ft.Icons.SEND_ROUNDED,
@@ -95,8 +223,20 @@ class ChatView(ft.Container):
             if e.ctrl and e.key == "Enter":
                 send_message(e)
         page.on_keyboard_event = keyboard_event
-        self.local_ip = self.get_local_ip()
-        self.pending_future = None
+        # IPアドレスの取得はソケット操作を伴うため、UIの構築を待たせないよう裏で取得する
+        cached_ip = _cached_local_ip()
+        self.local_ip = cached_ip or "…"
+        self.ip_text = ft.Text(
+            f"{self.local_ip}:",
+            style=_IP_TEXT_STYLE,
+        )
+        if cached_ip is None:
+            page.run_task(self._resolve_ip_async)
+        # 応答待ちのリクエスト (イベントループ, 応答を受け取る Future, 表示する会話履歴) の並び（到着順）
+        # 画面には先頭のリクエストの会話履歴を表示し、送信した応答はそのリクエストへ渡す
+        self._response_queues: deque[
+            tuple[asyncio.AbstractEventLoop, asyncio.Future, list[dict]]
+        ] = deque()
 
         self.content = ft.Column(
             [
@@ -106,10 +246,7 @@ class ChatView(ft.Container):
                         [
                             ft.Row(
                                 [
-                                    ft.Text(
-                                        f"{self.local_ip}:",
-                                        style=ft.TextStyle(size=12),
-                                    ),
+                                    self.ip_text,
                                     self.port_field,
                                     self.listen_button,
                                 ],
@@ -126,8 +263,8 @@ class ChatView(ft.Container):
                         alignment=ft.MainAxisAlignment.SPACE_AROUND,
                         vertical_alignment=ft.CrossAxisAlignment.CENTER,
                     ),
-                    padding=ft.padding.symmetric(horizontal=10, vertical=5),
-                    border=ft.border.only(bottom=ft.BorderSide(1, "outlineVariant")),
+                    padding=_TOP_BAR_PADDING,
+                    border=_BOTTOM_BORDER,
                 ),
                 # Messages Area
                 ft.Container(
@@ -147,117 +284,215 @@ class ChatView(ft.Container):
                         ],
                         spacing=2,
                     ),
-                    padding=ft.padding.all(10),
-                    border=ft.border.only(top=ft.BorderSide(1, "outlineVariant")),
+                    padding=_INPUT_AREA_PADDING,
+                    border=_TOP_BORDER,
                 ),
             ],
             spacing=0,
         )
     
-    def set_message(self, messages: list[str]):
-        self.messages_list.controls.clear()
-        for message in messages:
-            self._add_message(message["content"], message["role"] != "assistant")
-        self.messages_list.update()
-
-    def _add_message(self, message: str, is_user: bool = False, is_response = False):
-        alignment = (
-            ft.MainAxisAlignment.END
-            if not is_user
-            else ft.MainAxisAlignment.START
-        )
-        bubble_color = (
-            ft.Colors.BLUE_600 if not is_user else ft.Colors.WHITE
-        )
-        text_color = ft.Colors.WHITE if not is_user else ft.Colors.BLACK
+    def _replace_messages(self, messages: list[dict]):
+        """
+        メッセージ一覧のコントロールを置き換えます（画面への反映は呼び出し側でまとめて行う）
+        表示中の履歴と先頭から一致する部分はそのまま残し、異なる部分以降だけを作り直す
+        履歴が MAX_BUBBLES を超える場合は、末尾の MAX_BUBBLES 件だけを表示する
+        """
+        rendered = [(message["content"], message["role"]) for message in messages]
+        start = max(0, len(rendered) - MAX_BUBBLES)
+        shift = start - self._first_index
+        if 0 <= shift <= len(self._last_messages):
+            # 表示範囲が後ろにずれた分だけ先頭の吹き出しを外す
+            self._evict_head(shift)
+        else:
+            # 表示中の範囲と重ならない履歴なので、全て作り直す
+            self._evict_head(len(self._last_messages))
+            self._first_index = start
+        window = rendered[start:]
+        if window != self._last_messages:
+            k = _common_prefix_length(self._last_messages, window)
+            self._evicted_rows.extend(self.messages_list.controls[k:])
+            del self.messages_list.controls[k:]
+            del self._last_messages[k:]
+            for content, role in window[k:]:
+                self._add_message(content, role)
 
-        # Simple bubble implementation for now
-        bubble = ft.Container(
-            content=ft.Text(message, color=text_color),
-            bgcolor=bubble_color,
-            border_radius=10,
-            padding=10,
-            width=None,  # Allow auto width
-            #     constraints=ft.BoxConstraints(max_width=400), # Max width constraint
-        )
+    def _evict_head(self, n: int):
+        """
+        先頭の n 件の吹き出しを一覧から外す（外した Row は画面への反映後に _release_evicted でプールに入れる）
+        """
+        self._evicted_rows.extend(self.messages_list.controls[:n])
+        del self.messages_list.controls[:n]
+        del self._last_messages[:n]
+        self._first_index += n
 
-        row = ft.Row(
-            [bubble],
-            alignment=alignment,
-        )
+    def _release_evicted(self):
+        """
+        一覧から外した吹き出しを再利用に回す（画面への反映が済んだ後に呼ぶ）
+        """
+        self._bubble_pool.extend(self._evicted_rows[: _BUBBLE_POOL_SIZE - len(self._bubble_pool)])
+        self._evicted_rows.clear()
+
+    def _add_message(self, message: str, role: str = "assistant"):
+        """
+        メッセージの吹き出しを一覧に追加します（update は呼ばない）
+        """
+        is_user = role != "assistant"
+        alignment = _ALIGN_USER if is_user else _ALIGN_AI
+        bubble_color = _BG_USER if is_user else _BG_AI
+        text_color = _TXT_USER if is_user else _TXT_AI
+
+        if self._bubble_pool:
+            # 以前に一覧から外した吹き出しを、本文と色だけ差し替えて再利用する
+            row = self._bubble_pool.pop()
+            bubble = row.controls[0]
+            bubble.content.value = message
+            bubble.content.color = text_color
+            bubble.bgcolor = bubble_color
+            row.alignment = alignment
+        else:
+            # Simple bubble implementation for now
+            bubble = ft.Container(
+                content=ft.Text(message, color=text_color),
+                bgcolor=bubble_color,
+                border_radius=10,
+                padding=10,
+                width=None,  # Allow auto width
+                #     constraints=ft.BoxConstraints(max_width=400), # Max width constraint
+            )
+
+            row = ft.Row(
+                [bubble],
+                alignment=alignment,
+            )
         self.messages_list.controls.append(row)
-        if is_response:
-            self.messages_list.update()
-            if self.pending_future is not None and not self.pending_future.done():
-                self.pending_future.set_result(message)
+        self._last_messages.append((message, role))
+        if len(self._last_messages) > MAX_BUBBLES:
+            # 長時間の運用で一覧が際限なく伸びないよう、古いものから外す
+            self._evict_head(len(self._last_messages) - MAX_BUBBLES)
+
+    async def _resolve_ip_async(self):
+        """
+        ローカルIPアドレスを別スレッドで取得し、表示を更新する
+        """
+        ip = await asyncio.to_thread(self.get_local_ip)
+        self.local_ip = ip
+        self.ip_text.value = f"{ip}:"
+        if self.ip_text.page:
+            self.ip_text.update()
 
-    def get_local_ip(self):
+    @staticmethod
+    def get_local_ip():
         """
         外部サーバーに接続を試みることにより、使用中のローカルIPアドレスを取得する
+        環境変数 HCC_BIND_IP が設定されていればその値を、取得済みであればキャッシュを返す
         """
+        global _IP_CACHE
+        ip = _cached_local_ip()
+        if ip is not None:
+            return ip
         try:
             # UDPソケットを使用し、外部に出るためのルーティング情報を得る
-            with closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
                 s.connect(("8.8.8.8", 80))
-                return s.getsockname()[0]
+                ip = s.getsockname()[0]
+            finally:
+                s.close()
         except socket.error:
-            # エラー時はデフォルトとして localhost を返す
+            # エラー時はデフォルトとして localhost を返す（ネットワーク復帰後に再取得できるようキャッシュしない）
             return "127.0.0.1"
+        _IP_CACHE = (time.monotonic(), ip)
+        return ip
     
+    def _show_pending(self):
+        """
+        応答待ちの先頭のリクエストの会話履歴を表示し、応答の入力を受け付ける状態にする
+        応答待ちのリクエストが無ければ入力を無効にする
+        """
+        with self._view_lock:
+            self._render_pending()
+
+    def _render_pending(self):
+        """
+        _show_pending の本体（_view_lock を取った状態で呼ぶ）
+        """
+        # 待ち行列のロックは先頭を読む間だけ取り、差分計算や Flet への送信はロックの外で行う
+        with self._queue_lock:
+            entry = self._response_queues[0] if self._response_queues else None
+        self._shown_entry = entry
+        if entry is not None:
+            self._replace_messages(entry[2])
+            self.input_field.disabled = False
+            self.input_field.hint_text = "レスポンスメッセージを入力..."
+            self.send_button.disabled = False
+            self.send_button.bgcolor=ft.Colors.BLUE_600
+        else:
+            self.input_field.hint_text = "メッセージが来たらここへ入力..."
+            self.input_field.disabled = True
+            self.send_button.disabled = True
+            self.send_button.bgcolor=ft.Colors.GREY_400
+        # 変更したコントロールをまとめて1回の通信で反映する
+        self.page.update(self.messages_list, self.input_field, self.send_button)
+        self._release_evicted()
+
     async def on_message_received(self, messages: list[ChatCompletionRequestMessage]):
-        messages_json = []
-        for message in messages:
-            if not message.content:
-                continue
-            if isinstance(message, ChatCompletionRequestSystemMessage) or isinstance(message, ChatCompletionRequestDeveloperMessage):
-                if self.filter_system_prompt:
-                    continue
-                messages_json.append(message.model_dump())
-            elif isinstance(message, ChatCompletionRequestUserMessage):
-                if isinstance(message.content, str):
-                    messages_json.append(message.model_dump())
-                else:
-                    continue # TODO: PartMessageを処理する
-            elif isinstance(message, ChatCompletionRequestAssistantMessage):
-                messages_json.append(message.model_dump())
-            else:
-                continue
-        self.set_message(messages_json)
-        self.pending_future = asyncio.get_running_loop().create_future()
-        self.input_field.disabled = False
-        self.input_field.hint_text = "レスポンスメッセージを入力..."
-        self.send_button.disabled = False
-        self.send_button.bgcolor=ft.Colors.BLUE_600
-        self.input_field.update()
-        self.send_button.update()
-        result = await self.pending_future
-        return result
+        hidden_types = _SYSTEM_MESSAGE_TYPES if self.filter_system_prompt else ()
+        # 表示するものだけを選んでから、まとめて dict 化する（None のフィールドは画面で使わないので除く）
+        messages_json = [
+            message.model_dump(mode="json", exclude_none=True)
+            for message in messages
+            if message.content
+            and type(message) not in hidden_types
+            and _is_displayed(message)
+        ]
+        loop = asyncio.get_running_loop()
+        entry = (loop, loop.create_future(), messages_json)
+        with self._queue_lock:
+            self._response_queues.append(entry)
+            is_shown = self._response_queues[0] is entry
+        # 画面の更新（差分計算と Flet クライアントへの送信）はサーバーのイベントループを塞がないよう
+        # Flet のワーカースレッドで行い、こちらは応答を待つだけにする
+        # 他のリクエストへの応答中であれば、そちらの応答が済んでから表示する
+        if is_shown:
+            self.page.run_thread(self._show_pending)
+        try:
+            return await entry[1]
+        finally:
+            # クライアント切断等でキャンセルされた場合、以降の応答が渡らないよう待ち行列から外す
+            with self._queue_lock:
+                was_shown = bool(self._response_queues) and self._response_queues[0] is entry
+                try:
+                    self._response_queues.remove(entry)
+                except ValueError:
+                    # 既に応答の送信で取り出されている
+                    pass
+            if was_shown:
+                # 表示中のリクエストだった場合は、次のリクエストの表示（または入力の無効化）に切り替える
+                self.page.run_thread(self._show_pending)
         
     def toggle_server(self, e: ft.ControlEvent):
-        if self.listen_button.text == "STOPPED":
-            self.listen_button.text = "RUNNING"
-            self.listen_button.bgcolor = ft.Colors.GREEN_400
-            self.listen_button.disabled = True
-            self.port_field.disabled = True
-            self.listen_button.update()
-            self.port_field.update()
-            self.api_server = FastAPIServer(
-                host="0.0.0.0",
-                port=int(self.port_field.value),
-                log_level="info",
-                on_message_received=self.on_message_received,
-            )
-            self.api_server.start()
-            self.listen_button.disabled = False
-            self.listen_button.update()
-        else:
-            self.listen_button.text = "STOPPED"
-            self.listen_button.bgcolor = ft.Colors.RED_400
-            self.listen_button.disabled = True
-            self.listen_button.update()
-            if self.api_server:
+        if not self._toggle_lock.acquire(blocking=False):
+            # 起動・停止の処理中に続けて押された場合は無視する
+            return
+        try:
+            if self.api_server is None:
+                self.api_server = FastAPIServer(
+                    host="0.0.0.0",
+                    port=int(self.port_field.value),
+                    log_level="info",
+                    on_message_received=self.on_message_received,
+                )
+                self.api_server.start()
+                self.listen_button.text = "RUNNING"
+                self.listen_button.bgcolor = ft.Colors.GREEN_400
+                self.port_field.disabled = True
+            else:
                 self.api_server.stop()
-            self.port_field.disabled = False
-            self.listen_button.disabled = False
-            self.listen_button.update()
-            self.port_field.update()
+                self.api_server = None
+                self.listen_button.text = "STOPPED"
+                self.listen_button.bgcolor = ft.Colors.RED_400
+                self.port_field.disabled = False
+            # 状態の変更は最後にまとめて1回だけ反映する
+            self.page.update(self.listen_button, self.port_field)
+        finally:
+            self._toggle_lock.release()
@@ -5,18 +5,56 @@ from os import getenv
 
 import flet as ft
 
+# 下書きカードのスタイル
+_DRAFT_INDEX_COLOR = ft.Colors.GREY_600
+_DRAFT_INDEX_BGCOLOR = ft.Colors.GREY_200
+_DRAFT_ALIGNMENT = ft.MainAxisAlignment.START
+_DRAFT_VERTICAL_ALIGNMENT = ft.CrossAxisAlignment.START
+_DRAFT_BORDER = ft.border.all(1, "outlineVariant")
+
+_MODE_SEGMENT_PADDING = ft.padding.only(bottom=20)
+
+# ConsoleView のレイアウトで繰り返し使う列挙値
+_THEME_LIGHT = ft.ThemeMode.LIGHT.value
+_THEME_SYSTEM = ft.ThemeMode.SYSTEM.value
+_THEME_DARK = ft.ThemeMode.DARK.value
+_ERROR_COLOR = ft.Colors.RED_700
+_LABEL_COLOR = ft.Colors.GREY_700
+_BOLD = ft.FontWeight.BOLD
+_ALIGN_SPACE_BETWEEN = ft.MainAxisAlignment.SPACE_BETWEEN
+
 
 class ConsoleView(ft.Container):
     def __init__(self, page: ft.Page):
         super().__init__(expand=True, padding=20)
         self.page = page
+        # 右側のコンソールは起動直後のチャット操作には不要なため、
+        # 最初のフレームを送り終えるまでコントロールの構築を遅らせ、それまではインジケーターだけを置く
+        self._built = False
+        self.content = ft.Container(ft.ProgressRing(), alignment=ft.alignment.center)
+
+    def did_mount(self):
+        # ウィンドウ幅の変更でレイアウトが組み直される度に呼ばれるため、構築は初回のみ
+        # did_mount は page.add の中で同期的に呼ばれるため、ここで構築するとチャット側の表示も待たされる
+        # 構築はイベントループに回し、インジケーターを載せた最初のフレームを送ってから行う
+        if not self._built:
+            self._built = True
+            self.page.run_task(self._build_deferred)
+
+    async def _build_deferred(self):
+        self._build()
+        # 構築中にレイアウトの組み直しで外されていた場合は、次に追加された時に構築済みの内容が送られる
+        if self.page:
+            self.update()
+
+    def _build(self):
         # 1. Error Display Area (Hidden by default)
         self.error_container = ft.Container(
             content=ft.Row(
                 [
-                    ft.Icon(ft.Icons.ERROR_OUTLINE, color=ft.Colors.RED_700),
+                    ft.Icon(ft.Icons.ERROR_OUTLINE, color=_ERROR_COLOR),
                     ft.Text("API Key is missing (Auto-injected in runtime). Mocking response for demo.", 
-                            color=ft.Colors.RED_700, size=12, expand=True),
+                            color=_ERROR_COLOR, size=12, expand=True),
                 ],
                 alignment=ft.MainAxisAlignment.START,
             ),
@@ -31,21 +69,21 @@ class ConsoleView(ft.Container):
         self.settings_button = ft.IconButton(ft.Icons.SETTINGS, tooltip="Settings", disabled=True)
 
         self.theme_switch = ft.SegmentedButton(
-            selected={ft.ThemeMode.SYSTEM.value},
+            selected={_THEME_SYSTEM},
             allow_multiple_selection=False,
             segments=[
                 ft.Segment(
-                    value=ft.ThemeMode.LIGHT.value,
+                    value=_THEME_LIGHT,
                     label=ft.Text("Light Mode"),
                     icon=ft.Icon(ft.Icons.LIGHT_MODE),
                 ),
                 ft.Segment(
-                    value=ft.ThemeMode.SYSTEM.value,
+                    value=_THEME_SYSTEM,
                     label=ft.Text("System Mode"),
                     icon=ft.Icon(ft.Icons.BRIGHTNESS_6),
                 ),
                 ft.Segment(
-                    value=ft.ThemeMode.DARK.value,
+                    value=_THEME_DARK,
                     label=ft.Text("Dark Mode"),
                     icon=ft.Icon(ft.Icons.DARK_MODE),
                 ),
@@ -94,11 +132,9 @@ class ConsoleView(ft.Container):
 
         # 4. Drafts Area
         self.drafts_column = ft.Column(spacing=10)
-        # Dummy drafts for visualization
+        # 下書きが届くまではカード (_create_draft_card) を作らず、プレースホルダーだけを表示する
         self.drafts_column.controls = [
-            self._create_draft_card("1", "To be implemented"),
-            self._create_draft_card("2", "To be implemented"),
-            self._create_draft_card("3", "To be implemented"),
+            ft.Text("No drafts yet", size=13, color=_DRAFT_INDEX_COLOR),
         ]
         
         self.regenerate_button = ft.TextButton(
@@ -109,18 +145,18 @@ class ConsoleView(ft.Container):
         self.content = ft.Column(
             [
                 self.error_container,
-                ft.Text(f"Log file location: {getenv('FLET_APP_CONSOLE', 'unknown')}", color=ft.Colors.GREY_700),
+                ft.Text(f"Log file location: {getenv('FLET_APP_CONSOLE', 'unknown')}", color=_LABEL_COLOR),
                 ft.Divider(color=ft.Colors.TRANSPARENT, height=10),
 
-                ft.Row([ft.Text("Settings", weight=ft.FontWeight.BOLD), self.theme_switch, self.settings_button], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+                ft.Row([ft.Text("Settings", weight=_BOLD), self.theme_switch, self.settings_button], alignment=_ALIGN_SPACE_BETWEEN),
                 
                 ft.Row(
                     [
-                        ft.Text("Response Mode", weight=ft.FontWeight.BOLD, color=ft.Colors.GREY_700),
+                        ft.Text("Response Mode", weight=_BOLD, color=_LABEL_COLOR),
                     ],
-                    alignment=ft.MainAxisAlignment.SPACE_BETWEEN,
+                    alignment=_ALIGN_SPACE_BETWEEN,
                 ),
-                ft.Container(self.mode_segment, padding=ft.padding.only(bottom=20)),
+                ft.Container(self.mode_segment, padding=_MODE_SEGMENT_PADDING),
 
                 self.system_prompt,
                 
@@ -128,10 +164,10 @@ class ConsoleView(ft.Container):
                 
                 ft.Row(
                     [
-                        ft.Text("COPILOT Draft Candidates", weight=ft.FontWeight.BOLD, color=ft.Colors.GREY_700),
+                        ft.Text("COPILOT Draft Candidates", weight=_BOLD, color=_LABEL_COLOR),
                         self.regenerate_button
                     ],
-                    alignment=ft.MainAxisAlignment.SPACE_BETWEEN
+                    alignment=_ALIGN_SPACE_BETWEEN
                 ),
                 
                 self.drafts_column,
@@ -144,18 +180,18 @@ class ConsoleView(ft.Container):
             content=ft.Row(
                 [
                     ft.Container(
-                        content=ft.Text(index, size=12, weight=ft.FontWeight.BOLD, color=ft.Colors.GREY_600),
-                        bgcolor=ft.Colors.GREY_200,
+                        content=ft.Text(index, size=12, weight=_BOLD, color=_DRAFT_INDEX_COLOR),
+                        bgcolor=_DRAFT_INDEX_BGCOLOR,
                         padding=5,
                         border_radius=5,
                     ),
                     ft.Text(text, expand=True, size=13),
                 ],
-                alignment=ft.MainAxisAlignment.START,
-                vertical_alignment=ft.CrossAxisAlignment.START,
+                alignment=_DRAFT_ALIGNMENT,
+                vertical_alignment=_DRAFT_VERTICAL_ALIGNMENT,
             ),
             padding=10,
-            border=ft.border.all(1, "outlineVariant"),
+            border=_DRAFT_BORDER,
             border_radius=8,
             ink=True,
             disabled=True,